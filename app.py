@@ -1,8 +1,18 @@
+import functools
+import hashlib
+import itertools
 import os
+from datetime import date
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 import requests
-from flask import Flask, render_template, request, redirect, url_for
-from data_models import db, Author, Book
-from sqlalchemy.orm import joinedload
+from flask import Flask, render_template, request, redirect, url_for, g, has_request_context, stream_with_context, make_response
+from flask_caching import Cache
+from data_models import db, Author, Book, create_indexes, create_search_index, migrate_image_urls, normalize_dates
+from sqlalchemy import delete as sql_delete, event, insert, literal_column, select, table, text
+from sqlalchemy.engine import Engine
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.orm import Session, contains_eager, raiseload, selectinload
 
 app = Flask(__name__)
 
@@ -10,14 +20,98 @@ app = Flask(__name__)
 basedir = os.path.abspath(os.path.dirname(__file__))
 db_path = os.path.join(basedir, 'data', 'library.sqlite')
 app.config['SQLALCHEMY_DATABASE_URI'] = f"sqlite:///{db_path}"
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': QueuePool,  # keep the database file and its WAL open between requests
+    'pool_size': 10,
+    'max_overflow': 10,
+    'pool_pre_ping': True,
+    'pool_recycle': 3600,
+    'connect_args': {'check_same_thread': False, 'timeout': 30}  # share pooled connections across request threads
+}
 
 os.makedirs(os.path.join(basedir, 'data'), exist_ok=True)
 
 db.init_app(app)
 
-# Only needed once to create tables
-# with app.app_context():
-#   db.create_all()
+BOOKS_PER_PAGE = 50
+
+# Rendered book listings are cached for a minute and cleared whenever the books change
+cache = Cache(app, config={'CACHE_TYPE': 'SimpleCache', 'CACHE_DEFAULT_TIMEOUT': 60})
+
+
+@event.listens_for(Engine, "connect")
+def set_sqlite_pragmas(dbapi_connection, connection_record):
+    """
+    Tune every new SQLite connection for concurrent requests.
+
+    WAL mode lets readers keep working while a writer commits, and the remaining
+    pragmas relax fsyncs and keep temp tables, the page cache and memory-mapped
+    reads in memory.
+    """
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+
+    cursor = dbapi_connection.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA temp_store=MEMORY")
+    cursor.execute("PRAGMA mmap_size=268435456")
+    cursor.execute("PRAGMA cache_size=-64000")
+    cursor.close()
+
+
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    """
+    Count the SQL statements executed while handling a request in debug mode.
+    """
+    if has_request_context() and "query_count" in g:
+        g.query_count += 1
+
+
+# Create missing tables first, so the migrations below also work on a new database
+with app.app_context():
+    db.create_all()
+    normalize_dates()
+    migrate_image_urls()
+    create_indexes()
+    create_search_index()
+    event.listen(db.engine, "before_cursor_execute", count_query)
+
+
+@app.before_request
+def start_query_count():
+    """
+    Start counting the queries of the current request when running in debug mode.
+    """
+    if app.debug:
+        g.query_count = 0
+
+
+@app.after_request
+def log_query_count(response):
+    """
+    Log how many queries the current request ran, to spot N+1 regressions in debug mode.
+
+    The count is logged once the response is closed, so the queries of streamed
+    responses, which run while the body is being sent, are counted too.
+    """
+    if "query_count" in g:
+        counter, endpoint = g._get_current_object(), request.endpoint
+        response.call_on_close(lambda: app.logger.debug("route=%s queries=%d", endpoint, counter.query_count))
+    return response
+
+
+def lazy_load_guard():
+    """
+    Loader options that make relationships not loaded up front raise instead of lazily loading.
+
+    Only enabled in debug mode, so a template touching a relationship the view didn't
+    load fails loudly during development instead of running one query per row.
+
+    Returns:
+        list: The loader options to add to a listing query.
+    """
+    return [raiseload('*')] if app.debug else []
 
 
 @app.route('/add_author', methods=['GET', 'POST'])
@@ -32,13 +126,17 @@ def add_author():
     If the request method is GET, renders the form to add a new author.
 
     Returns:
-        str: Success message when a new author is added via POST.
+        str: Success message when a new author is added via POST,
+        tuple: An error message with 400 status code if a date is invalid.
         Response: Rendered HTML template for the add author form on GET.
     """
     if request.method == 'POST':
         name = request.form["name"]
-        birthdate = request.form["birthdate"]
-        date_of_death = request.form["date_of_death"]
+        try:
+            birthdate = date.fromisoformat(request.form["birthdate"])
+            date_of_death = date.fromisoformat(request.form["date_of_death"]) if request.form["date_of_death"] else None
+        except ValueError:
+            return "Dates must be in YYYY-MM-DD format", 400
 
         new_author = Author(
             name=name,
@@ -52,36 +150,110 @@ def add_author():
     return render_template('add_author.html')
 
 
-def fetch_book_image(title, isbn):
+# Reuse the connection to the Google Books API across lookups
+google_books = requests.Session()
+
+# Book images are fetched in the background so adding a book doesn't wait on the API
+image_fetcher = ThreadPoolExecutor(max_workers=4)
+
+
+@functools.lru_cache(maxsize=4096)
+def lookup_volume_id(title, isbn):
     """
-    Fetch the thumbnail image URL for a book using the Google Books API.
+    Look up the Google Books volume id of a book that has a cover image.
+
+    Results are cached per (title, isbn), so repeated lookups of the same book don't
+    go over the network again. Failed requests raise and are therefore not cached.
+
+    Args:
+        title (str): The title of the book.
+        isbn (str): The ISBN of the book.
+
+    Returns:
+        str: The volume id of the first search result if it has a thumbnail, otherwise an empty string.
+    """
+    response = google_books.get(
+        "https://www.googleapis.com/books/v1/volumes",
+        params={"q": f"{title} {isbn}"},
+        timeout=(3, 5)
+    )
+    response.raise_for_status()
+    data = response.json()
+
+    if "items" in data:
+        volume = data["items"][0]
+        if "thumbnail" in volume["volumeInfo"].get("imageLinks", {}):
+            return volume["id"]
+    return ""
+
+
+def fetch_volume_id(title, isbn):
+    """
+    Fetch the Google Books volume id used to show a book's cover image.
 
     Combines the book title and ISBN into a search query, sends a request to the
-    Google Books API, and attempts to retrieve the thumbnail image URL from the
-    first search result.
+    Google Books API, and returns the id of the first search result if it has a
+    thumbnail image. The image URL itself is built from the id by Book.image_url.
 
     Args:
         title (str): The title of the book.
         isbn (str): The ISBN of the book.
 
     Returns:
-        str: The URL of the book's thumbnail image if found, otherwise an empty string.
+        str: The volume id of the book if found, otherwise an empty string.
     """
     try:
-        query = f"{title} {isbn}"
-        url = f"https://www.googleapis.com/books/v1/volumes?q={query}"
-        response = requests.get(url)
-        data = response.json()
-
-        if "items" in data:
-            volume_info = data["items"][0]["volumeInfo"]
-            return volume_info.get("imageLinks", {}).get("thumbnail", "")
+        return lookup_volume_id(title, isbn)
     except Exception as e:
         print("Error fetching image:", e)
 
     return ""
 
 
+def update_book_image(book_id, title, isbn):
+    """
+    Fetch the Google Books volume id of a book and store it on the saved book.
+
+    Runs on the image_fetcher thread pool after the book has been committed, so it
+    opens its own application context.
+
+    Args:
+        book_id (int): The ID of the book to update.
+        title (str): The title of the book.
+        isbn (str): The ISBN of the book.
+    """
+    volume_id = fetch_volume_id(title, isbn)
+    if not volume_id:
+        return
+
+    with app.app_context():
+        book = db.session.get(Book, book_id)
+        if book:
+            book.google_volume_id = volume_id
+            db.session.commit()
+            cache.clear()
+
+
+def parse_publication_year(value):
+    """
+    Convert a publication year from a form or JSON payload to an integer.
+
+    Args:
+        value: The submitted year, as a string or an integer.
+
+    Returns:
+        int: The year, or None if no year was given.
+
+    Raises:
+        ValueError: If the value is not a whole number.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, bool) or not isinstance(value, (int, str)):
+        raise ValueError(f"Invalid publication year: {value!r}")
+    return int(value)
+
+
 @app.route('/add_book', methods=['GET', 'POST'])
 def add_book():
     """
@@ -90,89 +262,243 @@ def add_book():
     For GET requests, renders a form allowing users to input book information
     and select an author from the existing list.
 
-    For POST requests, receives form data for a new book, fetches its image
-    using the Google Books API, creates a new Book instance, and commits it
-    to the database.
+    For POST requests, receives form data for a new book, creates a new Book
+    instance and commits it to the database. Its image is then fetched from the
+    Google Books API in the background and saved once it arrives.
 
     Returns:
         str: A success message if the book is added (on POST),
-        Response: the rendered add_book.html template with the list of authors (on GET).
+        tuple: An error message with 400 status code if the publication year is invalid (on POST),
+        Response: the rendered add_book.html template with the list of authors (on GET),
+        or an empty 304 response if the browser's copy of the form is still current.
     """
     if request.method == 'POST':
         title = request.form["title"]
         isbn = request.form["isbn"]
-        publication_year = request.form["publication_year"]
+        try:
+            publication_year = parse_publication_year(request.form["publication_year"])
+        except ValueError:
+            return "Publication year must be a number", 400
         author_id = request.form["author_id"]
 
-        image_url = fetch_book_image(title, isbn)
+        # Reuse the image of a book with the same ISBN before asking the Google Books API
+        known_image = Book.query.filter(Book.isbn == isbn, Book.google_volume_id.isnot(None)).with_entities(Book.google_volume_id).first()
+        google_volume_id = known_image.google_volume_id if known_image else None
 
         new_book = Book(
             title=title,
             isbn=isbn,
             publication_year=publication_year,
             author_id=author_id,
-            image_url=image_url
+            google_volume_id=google_volume_id
         )
         db.session.add(new_book)
         db.session.commit()
+        cache.clear()
+
+        if not google_volume_id:
+            image_fetcher.submit(update_book_image, new_book.book_id, title, isbn)
         return "New book successfully added to database"
 
-    authors = Author.query.all()
-    return render_template('add_book.html', authors=authors)
+    authors = db.session.query(Author.author_id, Author.name).order_by(Author.name).all() # the dropdown only needs the id and name of each author
+
+    # The form only changes with the listed authors, so let the browser reuse its copy until then.
+    # The tag hashes the rows themselves because author ids can be reused after an author is deleted
+    etag = hashlib.sha1(repr([tuple(author) for author in authors]).encode()).hexdigest()
+    if request.if_none_match.contains(etag):
+        response = make_response("", 304)
+        response.set_etag(etag)
+        return response
+
+    response = make_response(render_template('add_book.html', authors=authors))
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def is_valid_book(book):
+    """
+    Check that a book from the /add_books payload has everything needed to insert it.
+
+    Args:
+        book: One element of the JSON array.
+
+    Returns:
+        bool: True if the book is an object with a non-empty string title and isbn
+        and an integer author_id.
+    """
+    if not isinstance(book, dict):
+        return False
+    title, isbn, author_id = book.get("title"), book.get("isbn"), book.get("author_id")
+    return (
+        isinstance(title, str) and title != ""
+        and isinstance(isbn, str) and isbn != ""
+        and isinstance(author_id, int) and not isinstance(author_id, bool)
+    )
+
+
+@app.route('/add_books', methods=['POST'])
+def add_books():
+    """
+    Add several books to the database at once from a JSON array.
+
+    Each element must be an object with a non-empty "title" and "isbn" and an integer
+    "author_id", and may have a "publication_year". All the books are inserted in a single statement and
+    committed together. Images are reused from books with the same ISBN, and the
+    missing ones are fetched from the Google Books API in the background.
+
+    Returns:
+        str: A success message with the number of books added,
+        tuple: An error message with 400 status code if the payload or a publication year is invalid.
+    """
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, list) or not all(is_valid_book(book) for book in payload):
+        return "Expected a JSON array of books with a non-empty title and isbn and an integer author_id", 400
+    if not payload:
+        return "0 books successfully added to database"
+    try:
+        publication_years = [parse_publication_year(book.get("publication_year")) for book in payload]
+    except ValueError:
+        return "Publication year must be a number", 400
+
+    isbns = {book["isbn"] for book in payload}
+    known_images = {
+        str(isbn): google_volume_id # older databases store the ISBN as an integer
+        for isbn, google_volume_id in Book.query.filter(Book.isbn.in_(isbns), Book.google_volume_id.isnot(None)).with_entities(Book.isbn, Book.google_volume_id)
+    }
+
+    rows = [
+        {
+            "title": book["title"],
+            "isbn": book["isbn"],
+            "publication_year": publication_year,
+            "author_id": book["author_id"],
+            "google_volume_id": known_images.get(str(book["isbn"]))
+        }
+        for book, publication_year in zip(payload, publication_years)
+    ]
+    book_ids = db.session.scalars(insert(Book).returning(Book.book_id, sort_by_parameter_order=True), rows).all()
+    db.session.commit()
+    cache.clear()
+
+    for book_id, row in zip(book_ids, rows):
+        if not row["google_volume_id"]:
+            image_fetcher.submit(update_book_image, book_id, row["title"], row["isbn"])
+    return f"{len(book_ids)} books successfully added to database"
+
+
+def stream_page(template_name, **context):
+    """
+    Render a template as a streamed response instead of building the whole page in memory.
+
+    Rendered chunks are buffered and sent a few at a time, so the client starts
+    receiving the page while the remaining rows are still being fetched and rendered.
+
+    Args:
+        template_name (str): The name of the template to render.
+        **context: The variables to make available in the template.
+
+    Returns:
+        Response: The streamed response.
+    """
+    app.update_template_context(context)
+    stream = app.jinja_env.get_template(template_name).stream(context)
+    stream.enable_buffering(5)
+    return app.response_class(stream_with_context(stream))
+
+
+def search_books(search):
+    """
+    Build a query for the books whose title contains the search term (case-insensitive).
+
+    On SQLite, terms of three or more characters are looked up in the book_fts
+    trigram index instead of scanning the book table; titles starting with the term
+    are found there too. Shorter terms cannot be split into trigrams, so they fall
+    back to a LIKE filter, as does every search on other databases (PostgreSQL serves
+    it from the pg_trgm index on the title).
+
+    Args:
+        search (str): The text to look for in the book titles.
+
+    Returns:
+        Query: A query of the Book objects matching the search term.
+    """
+    if db.engine.dialect.name != "sqlite" or len(search) < 3:
+        return Book.query.filter(Book.title.ilike(f"%{search}%"))
+
+    phrase = '"' + search.replace('"', '""') + '"' # quote the term so MATCH treats it as a plain substring
+    matching_ids = select(literal_column("rowid")).select_from(table("book_fts")).where(
+        text("book_fts MATCH :phrase").bindparams(phrase=phrase)
+    )
+    return Book.query.filter(Book.book_id.in_(matching_ids))
 
 
 @app.route('/', methods=['GET', 'POST'])
+@cache.cached(query_string=True, unless=lambda: request.method != 'GET')
 def home():
     """
     Display the list of books or search for books by title.
 
-    On GET retrieves and displays all books.
-    On POST, searches for books with titles matching the search query (case-insensitive).
+    On GET retrieves and displays one page of books, selected by the 'page' query parameter.
+    On POST, searches for books with titles matching the search query (case-insensitive)
+    and streams the results.
     If no books are found, displays a "No books found" message.
 
     Returns:
         str: An informational message if no books are found.
-        Response: Rendered 'home.html' template with a list of Book objects matching the query or all books.
+        Response: Rendered 'home.html' template with a list of Book objects matching the query or a page of all books.
     """
     if request.method == "POST":
         search = request.form["search"]
-        books = Book.query.filter(Book.title.ilike(f"%{search}%")).all()
-        if len(books) == 0:
+        # Search results aren't paginated, so rows are fetched and rendered in batches. They are loaded in
+        # their own session because db.session is closed when the view returns, before the page is streamed
+        session = Session(db.engine)
+        books = iter(search_books(search).with_session(session).options(selectinload(Book.author), *lazy_load_guard()).yield_per(100))
+        first_book = next(books, None) # peek at the first row instead of running the search twice
+        if first_book is None:
+            session.close()
             return "No books found"
-        return render_template('home.html', books=books)
+        response = stream_page('home.html', books=itertools.chain([first_book], books))
+        response.call_on_close(session.close) # also runs if the client goes away before the stream starts
+        return response
 
-    books = Book.query.all()
-    return render_template('home.html', books=books)
+    page = request.args.get('page', 1, type=int)
+    pagination = Book.query.order_by(Book.book_id).options(selectinload(Book.author), *lazy_load_guard()).paginate(page=page, per_page=BOOKS_PER_PAGE, error_out=False)
+    return render_template('home.html', books=pagination.items, pagination=pagination)
 
 
 @app.route('/sort_by_title', methods=['GET'])
+@cache.cached(query_string=True)
 def sort_by_title():
     """
-    Retrieve all books sorted alphabetically by their title and render them on the home page.
+    Retrieve a page of books sorted alphabetically by their title and render them on the home page.
 
     Returns:
-        Response: Rendered 'home.html' template with a list of Book objects sorted by title.
+        Response: Rendered 'home.html' template with a page of Book objects sorted by title.
     """
-    books = Book.query.order_by(Book.title).all()
-    return render_template('home.html', books=books)
+    page = request.args.get('page', 1, type=int)
+    pagination = Book.query.order_by(Book.title, Book.book_id).options(selectinload(Book.author), *lazy_load_guard()).paginate(page=page, per_page=BOOKS_PER_PAGE, error_out=False) # selectinload fetches all the authors in one extra query instead of one per book
+    return render_template('home.html', books=pagination.items, pagination=pagination)
 
 
 @app.route('/sort_by_author', methods=['GET'])
+@cache.cached(query_string=True)
 def sort_by_author():
     """
-    Retrieve all books sorted alphabetically by their author's name and render them on the home page.
+    Retrieve a page of books sorted alphabetically by their author's name and render them on the home page.
 
     Returns:
-        Response: Rendered 'home.html' template with a list of Book objects sorted by the author's name.
+        Response: Rendered 'home.html' template with a page of Book objects sorted by the author's name.
     """
-    books = Book.query.join(Author).order_by(Author.name).options(joinedload(Book.author)).all() #joinedload ensures the authors are loaded alongside the books efficiently when you sort by author’s name
-    return render_template('home.html', books=books)
+    page = request.args.get('page', 1, type=int)
+    pagination = Book.query.join(Author).order_by(Author.name, Book.book_id).options(contains_eager(Book.author), *lazy_load_guard()).paginate(page=page, per_page=BOOKS_PER_PAGE, error_out=False) # contains_eager fills book.author from the join used for sorting instead of joining the author table a second time
+    return render_template('home.html', books=pagination.items, pagination=pagination)
 
 
 @app.route('/book/<int:book_id>/delete', methods=['POST'])
 def delete(book_id):
     """
-    Deletes a book by its ID and removes any authors without remaining books.
+    Deletes a book by its ID and removes its author if they have no remaining books.
 
     Args:
         book_id (int): The ID of the book to delete.
@@ -181,18 +507,19 @@ def delete(book_id):
         Response: Redirects to the home page if the deletion is successful.
         str: Error message with 404 status code if the book is not found.
     """
-    book = Book.query.get(book_id)
-    if book:
-        db.session.delete(book)
-        db.session.commit()
+    # Delete without loading the book first; RETURNING hands back its author for the cleanup below
+    deleted = db.session.execute(
+        sql_delete(Book).where(Book.book_id == book_id).returning(Book.author_id)
+    ).first()
+    if deleted:
+        author_id = deleted.author_id
         print(f"Book with ID {book_id} deleted.")
 
-        # Check for authors without books
-        authors_ids_with_books = db.session.query(Book.author_id).distinct() # query only the author_id in the Book table
-        authors_ids_without_books = Author.query.filter(~Author.author_id.in_(authors_ids_with_books)) # query the whole Author table because e want to delete the whole author row
-
-        authors_ids_without_books.delete(synchronize_session=False)
+        # Only the author of the deleted book can have been left without books
+        if db.session.query(Book.book_id).filter_by(author_id=author_id).first() is None:
+            Author.query.filter_by(author_id=author_id).delete(synchronize_session=False)
         db.session.commit()
+        cache.clear()
 
         return redirect(url_for('home'))
     else:
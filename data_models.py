@@ -1,34 +1,162 @@
+from urllib.parse import parse_qs, urlparse
 from sqlalchemy.orm import relationship
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import Column, Integer, String, Text, ForeignKey
+from sqlalchemy import Column, Date, Integer, SmallInteger, String, ForeignKey, inspect, text
+from sqlalchemy.schema import CreateIndex
 
 db = SQLAlchemy()
 
 class Author(db.Model):
     author_id = Column(Integer, primary_key=True, autoincrement=True)
     name = Column(String, nullable=False)
-    birthdate = Column(String)
-    date_of_death = Column(String)
+    birthdate = Column(Date)
+    date_of_death = Column(Date)
 
     def __repr__(self):
         return f"name={self.name}, birth_date={self.birthdate}, date_of_death={self.date_of_death}"
 
     def __str__(self):
-        return f"{self.name} ({self.birthdate}-{self.date_of_death})"
+        return f"{self.name} ({self.birthdate}-{self.date_of_death or ''})"
 
 
 class Book(db.Model):
     book_id = Column(Integer, primary_key=True, autoincrement=True)
-    isbn = Column(String, nullable=False)
-    title = Column(String, nullable=False)
-    publication_year = Column(Integer)
-    author_id = Column(Integer, ForeignKey("author.author_id"))
-    image_url = Column(Text)
+    isbn = Column(String, nullable=False, index=True)
+    title = Column(String, nullable=False, index=True)
+    publication_year = Column(SmallInteger)
+    author_id = Column(Integer, ForeignKey("author.author_id"), index=True)
+    google_volume_id = Column(String(16))
 
     author = relationship("Author", backref="books")
 
+    @property
+    def image_url(self):
+        """The URL of the book's cover thumbnail on Google Books, or an empty string if unknown."""
+        if not self.google_volume_id:
+            return ""
+        return f"https://books.google.com/books/content?id={self.google_volume_id}&printsec=frontcover&img=1&zoom=1"
+
     def __repr__(self):
         return f"title={self.title}, publication_year={self.publication_year}"
 
     def __str__(self):
         return f"{self.title} ({self.publication_year})"
+
+
+def normalize_dates():
+    """
+    Clear the empty strings older versions stored for missing dates and years.
+
+    Dates are kept as ISO strings by SQLite, which the Date columns read back as-is,
+    but an empty string can't be parsed as a date or sorted as a year. The cleanup
+    runs once per database: PRAGMA user_version records it so later starts skip the
+    table scans. Other databases are created with the typed columns and need none.
+    """
+    if db.engine.dialect.name != "sqlite":
+        return
+    if db.session.execute(text("PRAGMA user_version")).scalar() >= 1:
+        return
+
+    db.session.execute(text("UPDATE author SET birthdate = NULL WHERE birthdate = ''"))
+    db.session.execute(text("UPDATE author SET date_of_death = NULL WHERE date_of_death = ''"))
+    db.session.execute(text("UPDATE book SET publication_year = NULL WHERE publication_year = ''"))
+    db.session.execute(text("PRAGMA user_version = 1"))
+    db.session.commit()
+
+
+def migrate_image_urls():
+    """
+    Move existing books from stored image URLs to Google Books volume ids.
+
+    Books used to store the full Google Books thumbnail URL in image_url. The volume
+    id is taken from the 'id' parameter of those URLs into google_volume_id, and the
+    image_url column is then dropped so the rows no longer carry the URLs.
+    """
+    columns = {column["name"] for column in inspect(db.engine).get_columns("book")}
+
+    if "google_volume_id" not in columns:
+        db.session.execute(text("ALTER TABLE book ADD COLUMN google_volume_id VARCHAR(16)"))
+        if "image_url" in columns:
+            rows = db.session.execute(text("SELECT book_id, image_url FROM book WHERE image_url != ''")).all()
+            volume_ids = []
+            for book_id, image_url in rows:
+                volume_id = parse_qs(urlparse(image_url).query).get("id", [None])[0]
+                if volume_id:
+                    volume_ids.append({"book_id": book_id, "volume_id": volume_id})
+            if volume_ids:
+                db.session.execute(
+                    text("UPDATE book SET google_volume_id = :volume_id WHERE book_id = :book_id"), volume_ids
+                )
+
+    if "image_url" in columns:
+        db.session.execute(text("ALTER TABLE book DROP COLUMN image_url"))
+    db.session.commit()
+
+
+def create_indexes():
+    """
+    Create the indexes declared on the Book model that are missing from the database.
+
+    db.create_all() doesn't alter tables that already exist, so databases created
+    before the indexes were declared need them added separately.
+    """
+    with db.engine.begin() as connection:
+        for index in Book.__table__.indexes:
+            connection.execute(CreateIndex(index, if_not_exists=True))
+        # Title prefixes are served by the search index, so this older index only slowed down writes
+        connection.execute(text("DROP INDEX IF EXISTS ix_book_title_lower"))
+
+
+def create_search_index():
+    """
+    Create the trigram index used to search books by title.
+
+    On SQLite, the book_fts FTS5 virtual table uses the trigram tokenizer, so a MATCH
+    on it finds the same substrings as a case-insensitive LIKE '%term%' without
+    scanning the whole book table. Triggers keep the index in sync with inserts,
+    deletes and title changes on the book table, and the index is filled from the
+    existing rows the first time it is created.
+
+    On PostgreSQL, a pg_trgm GIN index on the title lets ILIKE '%term%' use the
+    index directly.
+    """
+    dialect = db.engine.dialect.name
+    if dialect == "postgresql":
+        db.session.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        db.session.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_book_title_trgm ON book USING gin (title gin_trgm_ops)"
+        ))
+        db.session.commit()
+        return
+    if dialect != "sqlite":
+        return
+
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'book_fts'")
+    ).first()
+    if not exists:
+        db.session.execute(text(
+            "CREATE VIRTUAL TABLE book_fts USING fts5("
+            "title, content='book', content_rowid='book_id', tokenize='trigram')"
+        ))
+        db.session.execute(text("INSERT INTO book_fts(book_fts) VALUES ('rebuild')"))
+
+    db.session.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS book_fts_ai AFTER INSERT ON book BEGIN "
+        "INSERT INTO book_fts(rowid, title) VALUES (new.book_id, new.title); "
+        "END"
+    ))
+    db.session.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS book_fts_ad AFTER DELETE ON book BEGIN "
+        "INSERT INTO book_fts(book_fts, rowid, title) VALUES ('delete', old.book_id, old.title); "
+        "END"
+    ))
+    # Recreated on every start so databases with the older trigger, which fired on any column, get this one
+    db.session.execute(text("DROP TRIGGER IF EXISTS book_fts_au"))
+    db.session.execute(text(
+        "CREATE TRIGGER book_fts_au AFTER UPDATE OF title ON book BEGIN "
+        "INSERT INTO book_fts(book_fts, rowid, title) VALUES ('delete', old.book_id, old.title); "
+        "INSERT INTO book_fts(rowid, title) VALUES (new.book_id, new.title); "
+        "END"
+    ))
+    db.session.commit()